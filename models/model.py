@@ -308,7 +308,7 @@ class BE_Module(nn.Module):
 
         mask_cls = mask_cls.unsqueeze(-1)  # [B, 626, 1]
         mask_hidden_states = hidden_states * mask_cls # [B, 626, 768]
-        mask_hidden_states = mask_hidden_states.half()
+        mask_hidden_states = mask_hidden_states.to(hidden_states.dtype)
         return mask_hidden_states
 
 
@@ -350,7 +350,7 @@ class AQS_Module(nn.Module):
         filtered_matrix = filtered_matrix.unsqueeze(-1)
 
         new_noncls_hidden_states = noncls_hidden_states * filtered_matrix # [B, 626, 768]
-        new_noncls_hidden_states = new_noncls_hidden_states.half()
+        new_noncls_hidden_states = new_noncls_hidden_states.to(hidden_states.dtype)
         non_zero_tokens_mask = (new_noncls_hidden_states != 0).any(dim=-1)
         non_zero_token_counts = non_zero_tokens_mask.sum(dim=1)
         max_non_zero_tokens = non_zero_token_counts.max()
@@ -362,7 +362,7 @@ class AQS_Module(nn.Module):
             non_zero_tokens = new_noncls_hidden_states[i][non_zero_tokens_mask[i]]
             if non_zero_tokens.size(0) < max_non_zero_tokens:
                 padding_size = max_non_zero_tokens - non_zero_tokens.size(0)
-                padding = torch.zeros((padding_size, new_noncls_hidden_states.size(-1)), device=new_noncls_hidden_states.device).half()
+                padding = torch.zeros((padding_size, new_noncls_hidden_states.size(-1)), device=new_noncls_hidden_states.device, dtype=new_noncls_hidden_states.dtype)
                 non_zero_tokens = torch.cat([non_zero_tokens, padding], dim=0)
             filtered_hidden_states.append(non_zero_tokens)
 
@@ -414,7 +414,8 @@ class Encoder(nn.Module):
         total_threshold_loss += threshold_loss
         th_hidden_states, th_attn_weights = self.last_layer1(th_hidden_states, mask)
 
-        mask_hidden_states = self.BE_Module(mask,mask_hidden_states)
+        if mask is not None:  # non-BE runs have no background mask
+            mask_hidden_states = self.BE_Module(mask,mask_hidden_states)
         mask_hidden_states, mask_weights = self.last_layer2(mask_hidden_states,mask)
 
         th_encoded = self.encoder_norm(th_hidden_states)
@@ -333,7 +333,7 @@ class AQS_Module(nn.Module):
         filtered_matrix = filtered_matrix.unsqueeze(-1)
 
         new_noncls_hidden_states = noncls_hidden_states * filtered_matrix # [B, 626, 768]
-        new_noncls_hidden_states = new_noncls_hidden_states.half()
+        new_noncls_hidden_states = new_noncls_hidden_states.to(hidden_states.dtype)
         non_zero_tokens_mask = (new_noncls_hidden_states != 0).any(dim=-1)
         non_zero_token_counts = non_zero_tokens_mask.sum(dim=1)
         max_non_zero_tokens = non_zero_token_counts.max()
@@ -345,7 +345,7 @@ class AQS_Module(nn.Module):
             non_zero_tokens = new_noncls_hidden_states[i][non_zero_tokens_mask[i]]
             if non_zero_tokens.size(0) < max_non_zero_tokens:
                 padding_size = max_non_zero_tokens - non_zero_tokens.size(0)
-                padding = torch.zeros((padding_size, new_noncls_hidden_states.size(-1)), device=new_noncls_hidden_states.device).half()
+                padding = torch.zeros((padding_size, new_noncls_hidden_states.size(-1)), device=new_noncls_hidden_states.device, dtype=new_noncls_hidden_states.dtype)
                 non_zero_tokens = torch.cat([non_zero_tokens, padding], dim=0)
             filtered_hidden_states.append(non_zero_tokens)
 
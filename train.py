@@ -2,6 +2,7 @@
 from __future__ import absolute_import, division, print_function
 import logging
 import argparse
+import contextlib
 import os
 import random
 import numpy as np
@@ -13,19 +14,19 @@ import torch
 import torch.distributed as dist
 
 from tqdm import tqdm
+from torch.utils.data import DistributedSampler
 from torch.utils.tensorboard import SummaryWriter
-from apex import amp 
-from apex.parallel import DistributedDataParallel as DDP
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks
 
 # from models.model_INat2017 import VisionTransformer, CONFIGS
 from models.model import VisionTransformer, CONFIGS
 
 from utils.scheduler import WarmupLinearSchedule, WarmupCosineSchedule
-from utils.data_utils import get_loader
-from utils.dist_util import get_world_size
+from utils.data_utils import get_loader, get_gpu_augment, CudaPrefetcher
 
 import torch.multiprocessing as mp
-# mp.set_start_method('spawn', force=True)
+# DataLoader workers never touch CUDA, and fork lets them share the preloaded datasets copy-on-write
 mp.set_start_method('fork', force=True)
 
 logger = logging.getLogger(__name__)
@@ -49,10 +50,6 @@ class AverageMeter(object):
         self.avg = self.sum / self.count
 
 
-def simple_accuracy(preds, labels):
-    return (preds == labels).mean()
-
-
 def save_model(args, model, optimizer, scheduler, global_step, test_best_acc):
     model_to_save = model.module if hasattr(model, 'module') else model
     model_checkpoint = os.path.join(args.output_dir, "%s_checkpoint.bin" % args.name)
@@ -81,13 +78,6 @@ def resume_training(args, model, optimizer, scheduler):
     else:
         raise FileNotFoundError("No checkpoint found at {}".format(model_checkpoint))
 
-def reduce_mean(tensor, nprocs):
-    rt = tensor.clone()
-    dist.all_reduce(rt, op=dist.ReduceOp.SUM)
-    rt /= nprocs
-
-    return rt
-
 def setup(args):
     # Prepare model
     config = CONFIGS[args.model_type]
@@ -105,8 +95,22 @@ def setup(args):
 
     model = VisionTransformer(config, args.img_size, zero_head=True, num_classes=num_classes,smoothing_value=args.smoothing_value, dataset=args.dataset, \
          contr_loss=args.contr_loss, focal_loss=args.focal_loss)
-    model.load_from(np.load(args.pretrained_dir))
+    with np.load(args.pretrained_dir) as weights:
+        model.load_from(weights)
     model.to(args.device)
+    # NHWC matches the tensor-core layout for the patch-embedding conv
+    model = model.to(memory_format=torch.channels_last)
+    if args.compile:
+        # Only the embeddings and the encoder.layer blocks always see [B, n_patches + 1, hidden] inputs.
+        # AQS_Module and the blocks after it work on a data-dependent number of tokens and stay eager.
+        # Compiling the forward methods keeps the module tree, and so the checkpoint keys, unchanged.
+        # All blocks share the Block.forward code object, and Dynamo guards on the module and its train/eval
+        # mode, so one frame collects ~11 blocks x 2 modes x 2 batch sizes (full and last eval batch) entries.
+        # torch >= 2.1 defaults to 8 and then silently runs the remaining blocks eagerly.
+        torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 64)
+        model.transformer.embeddings.forward = torch.compile(model.transformer.embeddings.forward)
+        for block in model.transformer.encoder.layer:
+            block.forward = torch.compile(block.forward)
     num_params = count_parameters(model)
 
     logger.info("{}".format(config))
@@ -132,15 +136,16 @@ def set_seed(args):
 
 def valid(args, model, writer, test_loader, global_step):
     # Validation!
-    eval_losses = AverageMeter()
-
     logger.info("***** Running Validation *****")
     logger.info("  Num steps = %d", len(test_loader))
     logger.info("  Batch size = %d", args.eval_batch_size)
 
     model.eval()
-    all_preds, all_label = [], []
-    epoch_iterator = tqdm(test_loader,
+    # Running sums stay on the device so that no batch forces a host sync
+    correct = torch.zeros((), device=args.device)
+    total = torch.zeros((), device=args.device)
+    loss_sum = torch.zeros((), device=args.device)
+    epoch_iterator = tqdm(CudaPrefetcher(test_loader, args.device, memory_format=torch.channels_last),
                           desc="Validating... (loss=X.X)",
                           bar_format="{l_bar}{r_bar}",
                           dynamic_ncols=True,
@@ -150,8 +155,6 @@ def valid(args, model, writer, test_loader, global_step):
 
         if wnb: wandb.log({"step": step})
 
-        batch = tuple(t.to(args.device) for t in batch)
-        
         if args.aplly_BE:
             x, y, mask = batch
             
@@ -159,38 +162,33 @@ def valid(args, model, writer, test_loader, global_step):
             x, y = batch
 
         with torch.no_grad():
-            if args.aplly_BE:
-                logits = model(x, None, mask)[0]
-            else:
-                logits = model(x)[0]
+            with torch.cuda.amp.autocast(enabled=args.fp16, dtype=getattr(torch, args.amp_dtype)):
+                if args.aplly_BE:
+                    logits = model(x, None, mask)[0]
+                else:
+                    logits = model(x)[0]
         
             eval_loss = loss_fct(logits, y.long()) 
 
             if args.contr_loss:
                 eval_loss = eval_loss.mean()
 
-            eval_losses.update(eval_loss.item())
-
             preds = torch.argmax(logits, dim=-1)
 
-        if len(all_preds) == 0:
-            all_preds.append(preds.detach().cpu().numpy())
-            all_label.append(y.detach().cpu().numpy())
-        else:
-            all_preds[0] = np.append(
-                all_preds[0], preds.detach().cpu().numpy(), axis=0 )
-            all_label[0] = np.append(
-                all_label[0], y.detach().cpu().numpy(), axis=0 )
+            loss_sum += eval_loss.detach() * y.size(0)
+            correct += (preds == y.long()).sum()
+            total += y.numel()
 
-        epoch_iterator.set_description("Validating... (loss=%2.5f)" % eval_losses.val)
+        if step % 20 == 0:
+            epoch_iterator.set_description("Validating... (loss=%2.5f)" % (loss_sum / total).item())
 
-    all_preds, all_label = all_preds[0], all_label[0]
-    accuracy = simple_accuracy(all_preds, all_label)
+    accuracy = (correct / total).item()
+    avg_loss = (loss_sum / total).item()
 
     logger.info("\n")
     logger.info("Validation Results")
     logger.info("Global Steps: %d" % global_step)
-    logger.info("Valid Loss: %2.5f" % eval_losses.avg)
+    logger.info("Valid Loss: %2.5f" % avg_loss)
     logger.info("Valid Accuracy: %2.5f" % accuracy)
 
     writer.add_scalar("test/accuracy", scalar_value=accuracy, global_step=global_step)
@@ -210,9 +208,10 @@ def train(args, model, optimizer, scheduler):
 
     # Prepare dataset
     train_loader, test_loader = get_loader(args)
+    gpu_augment = get_gpu_augment(args)
 
     if optimizer is None:
-        optimizer = torch.optim.SGD(model.parameters(), lr=args.learning_rate, momentum=0.9, weight_decay=args.weight_decay)
+        optimizer = torch.optim.SGD(model.parameters(), lr=args.learning_rate, momentum=0.9, weight_decay=args.weight_decay, foreach=True)
     
     if scheduler is None:
         if args.decay_type == "cosine":
@@ -220,14 +219,19 @@ def train(args, model, optimizer, scheduler):
         else:
             scheduler = WarmupLinearSchedule(optimizer, warmup_steps=args.warmup_steps, t_total=args.num_steps)
 
-    if args.fp16:
-        model, optimizer = amp.initialize(models=model,
-                                          optimizers=optimizer,
-                                          opt_level=args.fp16_opt_level)
-        amp._amp_state.loss_scalers[0]._loss_scale = 2**20
+    # bfloat16 has the fp32 exponent range, so loss scaling is only needed for float16
+    amp_dtype = getattr(torch, args.amp_dtype)
+    # A positive --loss_scale is used as a fixed scale: it is never grown (it is still backed off on overflow)
+    scaler = torch.cuda.amp.GradScaler(init_scale=args.loss_scale or 2**20,
+                                       growth_interval=2**30 if args.loss_scale > 0 else 2000,
+                                       enabled=args.fp16 and amp_dtype == torch.float16)
 
     if args.local_rank != -1:
-        model = DDP(model, message_size=250000000, gradient_predivide_factor=get_world_size())
+        model = DDP(model, device_ids=[args.local_rank], output_device=args.local_rank, bucket_cap_mb=50,
+                    gradient_as_bucket_view=True, find_unused_parameters=False)
+        if args.fp16:
+            compress_hook = default_hooks.fp16_compress_hook if amp_dtype == torch.float16 else default_hooks.bf16_compress_hook
+            model.register_comm_hook(None, compress_hook)
 
     start_time = time.time()
     logger.info("***** Running training *****")
@@ -241,68 +245,74 @@ def train(args, model, optimizer, scheduler):
     model.zero_grad()
     set_seed(args)  # Added here for reproducibility (even between python 2 and 3)
     losses = AverageMeter()
+    window_losses = AverageMeter()  # loss over the steps since the last TensorBoard write
     global_step, best_acc = 0, 0
+    epoch = 0
 
     while True:
         model.train()
-        epoch_iterator = tqdm(train_loader,
+        if isinstance(train_loader.sampler, DistributedSampler):
+            # Reshuffle differently every epoch
+            train_loader.sampler.set_epoch(epoch)
+        epoch += 1
+
+        epoch_iterator = tqdm(CudaPrefetcher(train_loader, args.device, memory_format=torch.channels_last, augment=gpu_augment),
                               desc="Training (X / X Steps) (loss=X.X)",
                               bar_format="{l_bar}{r_bar}",
                               dynamic_ncols=True,
+                              mininterval=1.0,
                               disable=args.local_rank not in [-1, 0])
 
-        all_preds, all_label = [], []
+        correct = torch.zeros((), device=args.device, dtype=torch.long)
+        total = torch.zeros((), device=args.device, dtype=torch.long)
 
-        for step, batch in enumerate(epoch_iterator):       
-            batch = tuple(t.to(args.device) for t in batch)
+        for step, batch in enumerate(epoch_iterator):
+            is_accum_step = (step + 1) % args.gradient_accumulation_steps == 0
+            # Skip the DDP all-reduce on micro-steps whose gradients are only accumulated
+            sync_ctx = model.no_sync() if (args.local_rank != -1 and not is_accum_step) else contextlib.nullcontext()
 
-            if args.aplly_BE:
-                x, y, mask = batch
-                loss, logits = model(x, y, mask)
-            else:
-                x, y = batch
-                loss, logits = model(x, y)
+            with sync_ctx:
+                with torch.cuda.amp.autocast(enabled=args.fp16, dtype=amp_dtype):
+                    if args.aplly_BE:
+                        x, y, mask = batch
+                        loss, logits = model(x, y, mask)
+                    else:
+                        x, y = batch
+                        loss, logits = model(x, y)
 
-            if args.contr_loss:
-                loss = loss.mean()
+                if args.contr_loss:
+                    loss = loss.mean()
 
-            preds = torch.argmax(logits, dim=-1)
+                preds = torch.argmax(logits, dim=-1)
 
-            if len(all_preds) == 0:
-                all_preds.append(preds.detach().cpu().numpy())
-                all_label.append(y.detach().cpu().numpy())
-            else:
-                all_preds[0] = np.append(
-                    all_preds[0], preds.detach().cpu().numpy(), axis=0 )
-                all_label[0] = np.append(
-                    all_label[0], y.detach().cpu().numpy(), axis=0 )
-
-            if args.gradient_accumulation_steps > 1:
-                loss = loss / args.gradient_accumulation_steps
-            if args.fp16:
-                with amp.scale_loss(loss, optimizer) as scaled_loss:
-                    scaled_loss.backward()
-            else:
-                loss.backward()
-
-            if (step + 1) % args.gradient_accumulation_steps == 0:
+                correct += (preds == y.long()).sum()
+                total += y.numel()
+
+                if args.gradient_accumulation_steps > 1:
+                    loss = loss / args.gradient_accumulation_steps
+                scaler.scale(loss).backward()
+
+            if is_accum_step:
                 losses.update(loss.item()*args.gradient_accumulation_steps)
+                window_losses.update(losses.val)
 
-                if args.fp16:
-                    torch.nn.utils.clip_grad_norm_(amp.master_params(optimizer), args.max_grad_norm)
-                else:
-                    torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
+                scaler.unscale_(optimizer)
+                torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm, foreach=True)
 
-                optimizer.step()
+                scaler.step(optimizer)
+                scaler.update()
                 scheduler.step()
                 optimizer.zero_grad()
                 global_step += 1
 
-                epoch_iterator.set_description(
-                    "Training (%d / %d Steps) (loss=%2.5f)" % (global_step, args.num_steps, losses.val) )
-                if args.local_rank in [-1, 0]:
-                    writer.add_scalar("train/loss", scalar_value=losses.val, global_step=global_step)
-                    writer.add_scalar("train/lr", scalar_value=scheduler.get_lr()[0], global_step=global_step)
+                if global_step % 20 == 0:
+                    epoch_iterator.set_description(
+                        "Training (%d / %d Steps) (loss=%2.5f)" % (global_step, args.num_steps, losses.val) )
+                if global_step % 50 == 0:
+                    if args.local_rank in [-1, 0]:
+                        writer.add_scalar("train/loss", scalar_value=window_losses.avg, global_step=global_step)
+                        writer.add_scalar("train/lr", scalar_value=scheduler.get_lr()[0], global_step=global_step)
+                    window_losses.reset()
                 if global_step % args.eval_every == 0 and args.local_rank in [-1, 0]:
                     accuracy = valid(args, model, writer, test_loader, global_step)
                     if accuracy > best_acc:
@@ -314,12 +324,10 @@ def train(args, model, optimizer, scheduler):
                 if global_step % args.num_steps == 0:
                     break
 
-        all_preds, all_label = all_preds[0], all_label[0]
-        accuracy = simple_accuracy(all_preds, all_label)
-        accuracy = torch.tensor(accuracy).to(args.device)
-        dist.barrier()
-        train_accuracy = reduce_mean(accuracy, args.nprocs)
-        train_accuracy = train_accuracy.detach().cpu().numpy()
+        if args.local_rank != -1:
+            dist.all_reduce(correct)
+            dist.all_reduce(total)
+        train_accuracy = (correct.float() / total.float()).item()
         
         writer.add_scalar("train/accuracy", scalar_value=train_accuracy, global_step=global_step)
 
@@ -365,8 +373,8 @@ def main():
     parser.add_argument("--eval_every", default=200, type=int,
                         help="Run prediction on validation set every so many steps."
                              "Will always run one evaluation at the end of training.")
-    parser.add_argument("--num_workers", default=4, type=int,
-                        help="Number of workers for dataset preparation.")
+    parser.add_argument("--num_workers", default=8, type=int,
+                        help="Number of workers for dataset preparation. -1: min(CPU count - 2, 8).")
     parser.add_argument("--learning_rate", default=3e-2, type=float,
                         help="The initial learning rate for SGD.")
     parser.add_argument("--weight_decay", default=0, type=float,
@@ -379,7 +387,7 @@ def main():
                         help="Step of training to perform learning rate warmup for.")
     parser.add_argument("--max_grad_norm", default=1.0, type=float,
                         help="Max gradient norm.")
-    parser.add_argument("--local_rank", type=int, default=-1,
+    parser.add_argument("--local_rank", "--local-rank", type=int, default=-1,
                         help="local_rank for distributed training on gpus")
     parser.add_argument('--seed', type=int, default=42,
                         help="random seed for initialization")
@@ -387,19 +395,24 @@ def main():
                         help="Number of updates steps to accumulate before performing a backward/update pass.")
     parser.add_argument('--fp16', action='store_true',
                         help="Whether to use 16-bit float precision instead of 32-bit")
-    parser.add_argument('--fp16_opt_level', type=str, default='O2',
-                        help="For fp16: Apex AMP optimization level selected in ['O0', 'O1', 'O2', and 'O3']."
-                             "See details at https://nvidia.github.io/apex/amp.html")
+    parser.add_argument('--amp_dtype', choices=["float16", "bfloat16"], default=None,
+                        help="16-bit type used by autocast when fp16 is set. Default: bfloat16 if the GPU supports it, else float16.")
     parser.add_argument('--loss_scale', type=float, default=0,
-                        help="Loss scaling to improve fp16 numeric stability. Only used when fp16 set to True.\n"
-                             "0 (default value): dynamic loss scaling.\n"
-                             "Positive power of 2: static loss scaling value.\n")
+                        help="Loss scaling to improve fp16 numeric stability. Only used when fp16 set to True and amp_dtype is float16.\n"
+                             "0 (default value): dynamic loss scaling starting at 2**20.\n"
+                             "Positive power of 2: static loss scaling value (only lowered if gradients overflow).\n")
     parser.add_argument('--smoothing_value', type=float, default=0.0,
                         help="Label smoothing value\n")
     parser.add_argument('--aplly_BE', action='store_true',
                         help="Whether to use BE")
     parser.add_argument('--low_memory', action='store_true',
                         help="Allows to use less memory (RAM) during input image feeding. False: Slower - Do image pre-processing for the whole dataset at the beginning and store the results in memory. True: Faster - Do pre-processing on-the-go.")
+    parser.add_argument('--cache_resized', action='store_true',
+                        help="Non-BE CUB/dogs/nabirds only: decode and resize the whole train and test sets once into a uint8 tensor "
+                             "in RAM. Needs N x 3 x resize_size^2 bytes per process "
+                             "(about 7 GB for CUB and 29 GB for nabirds at 448), built single-threaded on every DDP rank.")
+    parser.add_argument('--compile', action='store_true',
+                        help="Whether to compile the fixed-shape part of the ViT (embeddings and encoder blocks) with torch.compile")
     parser.add_argument('--contr_loss', action='store_true',
                         help="Whether to use contrastive loss")
     parser.add_argument('--focal_loss', action='store_true',
@@ -423,7 +436,13 @@ def main():
                                              timeout=timedelta(minutes=600))
         args.n_gpu = 1
     args.device = device
-    args.nprocs = torch.cuda.device_count()
+
+    # Input shapes are fixed by img_size and the batch sizes, so the tuned cuDNN plans stay valid
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    if args.amp_dtype is None:
+        args.amp_dtype = "bfloat16" if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else "float16"
 
     # Setup logging
     logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
@@ -441,7 +460,7 @@ def main():
     # Resume training if a checkpoint exists
     optimizer, scheduler = None, None
     if args.start_step > 0:
-        optimizer = torch.optim.SGD(model.parameters(), lr=args.learning_rate, momentum=0.9, weight_decay=args.weight_decay)
+        optimizer = torch.optim.SGD(model.parameters(), lr=args.learning_rate, momentum=0.9, weight_decay=args.weight_decay, foreach=True)
         if args.decay_type == "cosine":
             scheduler = WarmupCosineSchedule(optimizer, warmup_steps=args.warmup_steps, t_total=args.num_steps)
         else:
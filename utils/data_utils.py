@@ -7,10 +7,116 @@ from .dataset import *
 from torch.utils.data import DataLoader, RandomSampler, DistributedSampler, SequentialSampler
 from PIL import Image
 from .autoaugment import AutoAugImageNetPolicy
+import kornia.augmentation as K
 import os
 
 logger = logging.getLogger(__name__)
 
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+
+
+class CudaPrefetcher(object):
+    """Iterates over a DataLoader, copying the next batch to the device on a side
+    CUDA stream while the current batch is consumed (cf. apex imagenet data_prefetcher).
+    The uint8 images (first tensor of the batch) are augmented and normalized on the device."""
+    def __init__(self, loader, device, mean=IMAGENET_MEAN, std=IMAGENET_STD, memory_format=torch.contiguous_format,
+                 augment=None):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream() if self.device.type == 'cuda' else None
+        # Without augmentation, normalize straight from the 0-255 range in a single pass
+        scale = 1 if augment is not None else 255
+        self.mean = torch.tensor(mean, device=self.device).view(1, 3, 1, 1) * scale
+        self.std = torch.tensor(std, device=self.device).view(1, 3, 1, 1) * scale
+        self.memory_format = memory_format
+        self.augment = augment
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.loader_iter = iter(self.loader)
+        self.preload()
+        batch = self.next()
+        while batch is not None:
+            yield batch
+            batch = self.next()
+
+    def preload(self):
+        try:
+            self.batch = next(self.loader_iter)
+        except StopIteration:
+            self.batch = None
+            return
+
+        if self.stream is None:
+            self.batch = self.to_device(self.batch)
+            return
+
+        with torch.cuda.stream(self.stream):
+            self.batch = self.to_device(self.batch)
+
+    def to_device(self, batch):
+        x, rest = batch[0], batch[1:]
+        x = x.to(self.device, non_blocking=True).float()
+        if self.augment is not None:
+            # Kornia expects images in [0, 1]
+            x = self.augment(x.div_(255))
+        x = x.sub_(self.mean).div_(self.std).contiguous(memory_format=self.memory_format)
+
+        return (x,) + tuple(t.to(self.device, non_blocking=True) for t in rest)
+
+    def next(self):
+        if self.stream is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+        batch = self.batch
+        if batch is not None and self.stream is not None:
+            # Tensors were allocated on the side stream but are consumed on the current one
+            for t in batch:
+                t.record_stream(torch.cuda.current_stream())
+        self.preload()
+
+        return batch
+
+
+def build_resized_tensor(dataset, size):
+    """Decodes and resizes every image of a dataset once into a uint8 tensor."""
+    transform = dataset.transform
+    dataset.transform = transforms.Compose([
+        transforms.Resize((size, size), Image.BILINEAR),
+        transforms.PILToTensor(),
+        ])
+
+    images = torch.empty((len(dataset), 3, size, size), dtype=torch.uint8)
+    targets = torch.empty(len(dataset), dtype=torch.long)
+    for i in range(len(dataset)):
+        images[i], targets[i] = dataset[i]
+
+    dataset.transform = transform
+
+    # Forked DataLoader workers share the buffer copy-on-write
+    return images, targets
+
+
+def tensor_transform(transform):
+    """Turns a PIL pipeline starting with Resize into one for pre-resized uint8 tensors."""
+    ops = [t for t in transform.transforms[1:] if not isinstance(t, transforms.PILToTensor)]
+
+    return transforms.Compose(ops)
+
+
+def get_gpu_augment(args):
+    """Batched training augmentations that replace the CPU ones of the non-BE CUB/dogs/nabirds pipelines."""
+    if args.aplly_BE or args.dataset not in ["CUB", "dogs", "nabirds"]:
+        return None
+
+    return torch.nn.Sequential(
+        K.RandomCrop((args.img_size, args.img_size)),
+        K.RandomHorizontalFlip(p=0.5),
+        K.ColorJitter(0.4, 0.4, 0.4, 0.0),
+        ).to(args.device)
+
 
 def get_loader(args):
     if args.local_rank not in [-1, 0]:
@@ -38,34 +144,27 @@ def get_loader(args):
                 transforms.ColorJitter(brightness=0.4, contrast=0.4, saturation=0.4),
                 # transforms.RandomHorizontalFlip(), !!! FLIPPING in dataset.py !!!
                 
-                transforms.ToTensor(),
-                transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+                transforms.PILToTensor()
                 ])
                                         
             test_transform=transforms.Compose([
                 transforms.Resize((args.img_size, args.img_size), Image.BILINEAR),
 
-                transforms.ToTensor(),
-                transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+                transforms.PILToTensor()
                 ])
         else:
             train_transform=transforms.Compose([
                 transforms.Resize((args.resize_size, args.resize_size), Image.BILINEAR),
-                transforms.RandomCrop((args.img_size, args.img_size)),
-
-                transforms.ColorJitter(brightness=0.4, contrast=0.4, saturation=0.4),
-                transforms.RandomHorizontalFlip(),
+                # RandomCrop, ColorJitter and RandomHorizontalFlip run on the GPU, see get_gpu_augment
 
-                transforms.ToTensor(),
-                transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+                transforms.PILToTensor()
                 ])
                                         
             test_transform=transforms.Compose([
                 transforms.Resize((args.resize_size, args.resize_size), Image.BILINEAR),
                 transforms.CenterCrop((args.img_size, args.img_size)),
 
-                transforms.ToTensor(),
-                transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+                transforms.PILToTensor()
                 ])
 
         trainset = dogs(args.dataset, 
@@ -99,34 +198,27 @@ def get_loader(args):
                 transforms.ColorJitter(brightness=0.4, contrast=0.4, saturation=0.4),
                 #transforms.RandomHorizontalFlip(), # !!! FLIPPING in dataset.py !!!
 
-                transforms.ToTensor(),
-                transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
+                transforms.PILToTensor(),
                 ])
 
             test_transform=transforms.Compose([
                 transforms.Resize((args.img_size, args.img_size),Image.BILINEAR),
 
-                transforms.ToTensor(),
-                transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+                transforms.PILToTensor()
                 ])
         else:
             train_transform=transforms.Compose([
                 transforms.Resize((args.resize_size, args.resize_size),Image.BILINEAR),
-                transforms.RandomCrop((args.img_size, args.img_size)),
-
-                transforms.ColorJitter(brightness=0.4, contrast=0.4, saturation=0.4),
-                transforms.RandomHorizontalFlip(),
+                # RandomCrop, ColorJitter and RandomHorizontalFlip run on the GPU, see get_gpu_augment
                 
-                transforms.ToTensor(),
-                transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
+                transforms.PILToTensor(),
                 ])
                                             
             test_transform=transforms.Compose([
                 transforms.Resize((args.resize_size, args.resize_size), Image.BILINEAR),
                 transforms.CenterCrop((args.img_size, args.img_size)),
 
-                transforms.ToTensor(),
-                transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+                transforms.PILToTensor()
                 ])
         
 
@@ -145,34 +237,27 @@ def get_loader(args):
                 transforms.ColorJitter(brightness=0.4, contrast=0.4, saturation=0.4), # my add (from FFVT) mb try?
                 #transforms.RandomHorizontalFlip(), # !!! FLIPPING in dataset.py !!!
 
-                transforms.ToTensor(),
-                transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])                                        
+                transforms.PILToTensor()                                        
                 ])
 
             test_transform=transforms.Compose([
                 transforms.Resize((args.img_size, args.img_size), Image.BILINEAR),
 
-                transforms.ToTensor(),
-                transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])                                          
+                transforms.PILToTensor()                                          
                 ])
         else:
             train_transform=transforms.Compose([
                 transforms.Resize((args.resize_size, args.resize_size), Image.BILINEAR),
-                transforms.RandomCrop((args.img_size, args.img_size)),
+                # RandomCrop, ColorJitter and RandomHorizontalFlip run on the GPU, see get_gpu_augment
 
-                transforms.ColorJitter(brightness=0.4, contrast=0.4, saturation=0.4),
-                transforms.RandomHorizontalFlip(),
-
-                transforms.ToTensor(),
-                transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])                                        
+                transforms.PILToTensor()                                        
                 ])
 
             test_transform=transforms.Compose([
                 transforms.Resize((args.resize_size, args.resize_size), Image.BILINEAR),
                 transforms.CenterCrop((args.img_size, args.img_size)),
 
-                transforms.ToTensor(),
-                transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])                                          
+                transforms.PILToTensor()                                          
                 ])            
 
 
@@ -188,17 +273,23 @@ def get_loader(args):
                                     transforms.RandomCrop((304, 304)),
                                     transforms.RandomHorizontalFlip(),
                                     AutoAugImageNetPolicy(),
-                                    transforms.ToTensor(),
-                                    transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])])
+                                    transforms.PILToTensor()])
         test_transform=transforms.Compose([transforms.Resize((400, 400), Image.BILINEAR),
                                     transforms.CenterCrop((304, 304)),
-                                    transforms.ToTensor(),
-                                    transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])])
+                                    transforms.PILToTensor()])
         trainset = INat2017(args.data_root, 'train', train_transform)
         testset = INat2017(args.data_root, 'val', test_transform)        
     
 
 
+    if args.cache_resized and not args.aplly_BE and args.dataset in ["CUB", "dogs", "nabirds"]:
+        logger.info("Caching resized %s images in memory..." % args.dataset)
+        trainset = ResizedTensorDataset(*build_resized_tensor(trainset, args.resize_size),
+                                        transform=tensor_transform(train_transform))
+        testset = ResizedTensorDataset(*build_resized_tensor(testset, args.resize_size),
+                                       transform=tensor_transform(test_transform))
+
+
     if args.local_rank == 0:
         # torch.distributed.new_group(backend="gloo",timeout=datetime.timedelta(days=1))
         torch.distributed.barrier()
@@ -206,15 +297,21 @@ def get_loader(args):
     train_sampler = RandomSampler(trainset) if args.local_rank == -1 else DistributedSampler(trainset)
     test_sampler = SequentialSampler(testset) if args.local_rank == -1 else DistributedSampler(testset)
     # test_sampler = SequentialSampler(testset)
+    num_workers = args.num_workers if args.num_workers >= 0 else max(min((os.cpu_count() or 4) - 2, 8), 0)
+    # Keep workers alive across epochs and a few batches ahead of the GPU
+    worker_kwargs = dict(persistent_workers=True, prefetch_factor=4) if num_workers > 0 else {}
+
     train_loader = DataLoader(trainset,
                               sampler=train_sampler,
                               batch_size=args.train_batch_size,
-                              num_workers=args.num_workers,
-                              pin_memory=True)
+                              num_workers=num_workers,
+                              pin_memory=True,
+                              **worker_kwargs)
     test_loader = DataLoader(testset,
                              sampler=test_sampler,
                              batch_size=args.eval_batch_size,
-                             num_workers=args.num_workers,
-                             pin_memory=True) if testset is not None else None
+                             num_workers=num_workers,
+                             pin_memory=True,
+                             **worker_kwargs) if testset is not None else None
 
     return train_loader, test_loader
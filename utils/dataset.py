@@ -375,8 +375,7 @@ class Generic_BE_DS():
                             transforms.ColorJitter(brightness=0.4, contrast=0.4, saturation=0.4), # my add (FFVT)
                             transforms.RandomHorizontalFlip(p=1.0), # !!! FLIPPING in dataset.py !!!
 
-                            transforms.ToTensor(),
-                            transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
+                            transforms.PILToTensor(),
                             ])
                         img = transform_img_flip(img)
             else:
@@ -651,8 +650,7 @@ class Generic_BE_DS():
                             transforms.ColorJitter(brightness=0.4, contrast=0.4, saturation=0.4), # my add (FFVT)
                             transforms.RandomHorizontalFlip(p=1.0), # !!! FLIPPING in dataset.py !!!
 
-                            transforms.ToTensor(),
-                            transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
+                            transforms.PILToTensor(),
                             ])
                         img = transform_img_flip(img)
             else:
@@ -1529,3 +1527,21 @@ class INat2017(VisionDataset):
                 raise RuntimeError("File not found or corrupted.")
 
 
+
+class ResizedTensorDataset(Dataset):
+    """Serves images that were decoded and resized once into a uint8 tensor of shape (N, 3, H, W)."""
+
+    def __init__(self, images, targets, transform=None):
+        self.images = images
+        self.targets = targets
+        self.transform = transform
+
+    def __getitem__(self, index):
+        img, target = self.images[index], self.targets[index]
+        if self.transform is not None:
+            img = self.transform(img)
+
+        return img, target
+
+    def __len__(self):
+        return len(self.targets)